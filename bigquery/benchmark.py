@@ -0,0 +1,555 @@
+"""End-to-end indexer benchmark on synthetic data.
+
+Generates participant, sample and time series tables, then runs the same
+functions as indexer.py on them: index_fields, create_mappings, index_table
+and create_samples_json_export_file. BigQuery and GCS are replaced by
+in-process fakes. Elasticsearch is replaced by a fake that runs in a separate
+process, and implements just enough of the API for the indexer; pass
+--elasticsearch_url to use a real Elasticsearch instead.
+
+Prints a JSON report with time, rows/sec, bytes and peak RSS per stage. Export
+files are generated before timing starts, and memory is reported over a
+baseline taken after setup, so neither includes synthetic data generation.
+Runs with the same arguments are comparable, so reports can be tracked for
+regressions.
+
+From bigquery directory, run:
+  python benchmark.py --num_participants 10000 --num_columns 20 --output report.json
+"""
+import argparse
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from urllib.parse import urlparse
+
+from indexer_util import indexer_util
+from indexer_util import metrics
+
+import indexer
+
+logger = logging.getLogger('indexer.bigquery.benchmark')
+
+INDEX_NAME = 'benchmark'
+FIELDS_INDEX_NAME = 'benchmark_fields'
+DEPLOY_PROJECT_ID = 'benchmark'
+PARTICIPANT_ID_COLUMN = 'participant_id'
+SAMPLE_ID_COLUMN = 'sample_id'
+TIME_SERIES_COLUMN = 'time'
+SAMPLE_FILE_COLUMNS = {'BAM': 'benchmark.synthetic.samples.bam'}
+
+# Cycle through these types for synthetic columns.
+COLUMN_TYPES = ['INTEGER', 'FLOAT', 'STRING', 'BOOLEAN']
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--elasticsearch_url',
+        type=str,
+        help='Elasticsearch url. If not set, a fake Elasticsearch is used.')
+    parser.add_argument('--num_participants', type=int, default=10000)
+    parser.add_argument('--num_columns',
+                        type=int,
+                        default=20,
+                        help='Number of columns in each table, not counting '
+                        'id and time series columns.')
+    parser.add_argument('--samples_per_participant', type=int, default=2)
+    parser.add_argument('--num_time_points', type=int, default=5)
+    parser.add_argument('--rows_per_shard',
+                        type=int,
+                        default=100000,
+                        help='Rows per fake BigQuery export file.')
+    parser.add_argument(
+        '--time_series_layout',
+        type=str,
+        choices=indexer.TIME_SERIES_LAYOUTS,
+        default=indexer.TIME_SERIES_LAYOUT_OBJECT,
+    )
+    parser.add_argument('--metrics',
+                        action='store_true',
+                        help='Add the indexer metrics report, which breaks '
+                        'down time within each stage, to the output.')
+    parser.add_argument('--output',
+                        type=str,
+                        help='Write JSON report to this file instead of '
+                        'stdout.')
+    return parser.parse_args()
+
+
+class _FakeSchemaField(object):
+    """Has the attributes of bigquery.SchemaField used by indexer.py."""
+
+    def __init__(self, name, field_type):
+        self.name = name
+        self.field_type = field_type
+        self.mode = 'NULLABLE'
+        self.description = 'Synthetic %s column' % field_type
+        self.fields = ()
+
+
+class _FakeTable(object):
+    """Has the attributes of bigquery.Table used by indexer.py."""
+
+    def __init__(self, table_name, id_columns, num_columns, rows):
+        project_id, dataset_id, table_id = table_name.rsplit('.', 2)
+        self.full_table_id = '%s:%s.%s' % (project_id, dataset_id, table_id)
+        self.table_type = 'TABLE'
+        self.schema = [
+            _FakeSchemaField(name, field_type)
+            for name, field_type in id_columns
+        ] + [
+            _FakeSchemaField('col_%d' % i, COLUMN_TYPES[i % len(COLUMN_TYPES)])
+            for i in range(num_columns)
+        ]
+        # Function that returns an iterator of rows.
+        self.rows = rows
+
+
+def _random_value(rand, field_type):
+    # Values look like values in a BigQuery JSON export.
+    if field_type == 'INTEGER':
+        return str(rand.randint(0, 100))
+    elif field_type == 'FLOAT':
+        return rand.random() * 100
+    elif field_type == 'BOOLEAN':
+        return rand.random() < 0.5
+    return rand.choice(['alpha', 'beta', 'gamma', 'delta'])
+
+
+def _synthetic_tables(args):
+    num_columns = args.num_columns
+
+    def rows(table, key_rows):
+        # Use a fixed seed, so every run indexes the same data.
+        rand = random.Random(0)
+        for row in key_rows():
+            for field in table.schema[len(row):]:
+                row[field.name] = _random_value(rand, field.field_type)
+            yield row
+
+    participants = _FakeTable('benchmark.synthetic.participants',
+                              [(PARTICIPANT_ID_COLUMN, 'STRING')], num_columns,
+                              None)
+    participants.rows = lambda: rows(
+        participants, lambda: ({
+            PARTICIPANT_ID_COLUMN: str(p)
+        } for p in range(args.num_participants)))
+
+    samples = _FakeTable('benchmark.synthetic.samples',
+                         [(PARTICIPANT_ID_COLUMN, 'STRING'),
+                          (SAMPLE_ID_COLUMN, 'STRING'),
+                          ('bam', 'STRING')], num_columns, None)
+    samples.rows = lambda: rows(
+        samples, lambda: ({
+            PARTICIPANT_ID_COLUMN: str(p),
+            SAMPLE_ID_COLUMN: '%d_%d' % (p, s),
+            'bam': 'gs://benchmark/%d_%d.bam' % (p, s)
+        } for p in range(args.num_participants)
+                          for s in range(args.samples_per_participant)))
+
+    time_series = _FakeTable('benchmark.synthetic.time_series',
+                             [(PARTICIPANT_ID_COLUMN, 'STRING'),
+                              (TIME_SERIES_COLUMN, 'INTEGER')], num_columns,
+                             None)
+    time_series.rows = lambda: rows(
+        time_series, lambda: ({
+            PARTICIPANT_ID_COLUMN: str(p),
+            TIME_SERIES_COLUMN: str(t)
+        } for t in range(args.num_time_points)
+                              for p in range(args.num_participants)))
+    time_series_vals = [
+        indexer._encode_tsv(t) for t in range(args.num_time_points)
+    ]
+    return [(participants, []), (samples, []), (time_series, time_series_vals)]
+
+
+class _FakeBlob(object):
+
+    def __init__(self, bucket, name):
+        self._bucket = bucket
+        self.name = name
+        self.path = '/b/%s/o/%s' % (bucket.name, name)
+
+    def download_as_string(self):
+        return self._bucket.objects[self.name]
+
+    def upload_from_string(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._bucket.objects[self.name] = data
+
+    def delete(self):
+        del self._bucket.objects[self.name]
+
+
+class _FakeBucket(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+
+    def blob(self, name):
+        return _FakeBlob(self, name)
+
+    def list_blobs(self, prefix):
+        for name in sorted(self.objects):
+            if name.startswith(prefix):
+                yield _FakeBlob(self, name)
+
+
+class _FakeStorageClient(object):
+    """In-memory GCS, with the methods of storage.Client used by indexer.py."""
+
+    def __init__(self):
+        self.buckets = {}
+
+    def lookup_bucket(self, name):
+        return self.buckets.get(name)
+
+    def create_bucket(self, name):
+        self.buckets[name] = _FakeBucket(name)
+        return self.buckets[name]
+
+    def get_bucket(self, name):
+        return self.buckets[name]
+
+
+class _FakeJob(object):
+
+    def result(self, timeout=None):
+        return self
+
+
+class _FakeBigQueryClient(object):
+    """Copies export files to a _FakeStorageClient on extract_table().
+
+    Export files are generated by prepare_export(), before timing starts, so
+    that index_table() times don't include generating synthetic data.
+    """
+
+    def __init__(self, storage_client, rows_per_shard):
+        self._storage_client = storage_client
+        self._rows_per_shard = rows_per_shard
+        self._shards_by_table_id = {}
+        self.bytes_exported = 0
+
+    def _shard_data(self, lines):
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.bytes_exported += len(data)
+        return data
+
+    def prepare_export(self, table):
+        """Generates the export files of table. Returns number of rows."""
+        shards = []
+        lines = []
+        num_rows = 0
+        for row in table.rows():
+            lines.append(json.dumps(row))
+            num_rows += 1
+            if len(lines) == self._rows_per_shard:
+                shards.append(self._shard_data(lines))
+                lines = []
+        if lines:
+            shards.append(self._shard_data(lines))
+        self._shards_by_table_id[table.full_table_id] = shards
+        return num_rows
+
+    def extract_table(self, table, destination_uri, job_id, job_config):
+        # destination_uri looks like gs://bucket/prefix*.json
+        bucket_name, prefix = re.match(r'gs://([^/]+)/(.*)\*\.json',
+                                       destination_uri).groups()
+        bucket = self._storage_client.get_bucket(bucket_name)
+        # Hand the files over to the bucket. The indexer deletes them once
+        # read, so they are freed as they would be with real GCS.
+        shards = self._shards_by_table_id.pop(table.full_table_id)
+        for shard, data in enumerate(shards):
+            blob_name = '%s%012d.json' % (prefix, shard)
+            bucket.blob(blob_name).upload_from_string(data)
+        return _FakeJob()
+
+
+class _FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    """Implements the parts of the Elasticsearch API used by indexer.py.
+
+    Updates, including the painless scripts in indexer.py, are applied to an
+    in-memory dict so that create_samples_json_export_file() sees the indexed
+    samples.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Otherwise every response waits for a delayed ACK.
+    disable_nagle_algorithm = True
+    indices = {}
+    stats = {'bulk_requests': 0, 'bulk_actions': 0, 'bulk_bytes': 0}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, obj, status=200):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _apply_update(self, index_name, _id, action):
+        doc = self.indices.setdefault(index_name, {}).setdefault(_id, {})
+        if 'doc' in action:
+            doc.update(action['doc'])
+            return
+        params = action['script']['params']
+        if 'sample' in params:
+            sample = params['sample']
+            samples = doc.setdefault('samples', [])
+            for existing in samples:
+                if existing[SAMPLE_ID_COLUMN] == sample[SAMPLE_ID_COLUMN]:
+                    existing.update(sample)
+                    break
+            else:
+                samples.append(sample)
+        elif 'tsv' in params:
+            for k, v in params['row'].items():
+                doc.setdefault(k, {'_is_time_series': True})[params['tsv']] = v
+        else:
+            for k, v in params['row'].items():
+                points = [p for p in doc.get(k, []) if p['t'] != params['t']]
+                doc[k] = points + [{'t': params['t'], 'value': v}]
+
+    def _bulk(self, body):
+        self.stats['bulk_requests'] += 1
+        self.stats['bulk_bytes'] += len(body)
+        lines = body.decode('utf-8').splitlines()
+        items = []
+        for meta_line, action_line in zip(lines[0::2], lines[1::2]):
+            meta = json.loads(meta_line)['update']
+            self._apply_update(meta['_index'], meta['_id'],
+                               json.loads(action_line))
+            items.append({'update': {'_id': meta['_id'], 'status': 200}})
+        self.stats['bulk_actions'] += len(items)
+        self._send({'took': 1, 'errors': False, 'items': items})
+
+    def _search(self, index_name):
+        # Return every document in the first page; the next scroll is empty.
+        hits = [{
+            '_index': index_name,
+            '_type': 'type',
+            '_id': _id,
+            '_source': doc
+        } for _id, doc in self.indices.get(index_name, {}).items()]
+        self._search_response(hits)
+
+    def _search_response(self, hits):
+        self._send({
+            '_scroll_id': 'benchmark',
+            '_shards': {
+                'total': 1,
+                'successful': 1,
+                'skipped': 0,
+                'failed': 0
+            },
+            'hits': {
+                'total': len(hits),
+                'hits': hits
+            }
+        })
+
+    def _handle(self):
+        path = urlparse(self.path).path.strip('/').split('/')
+        body = self._body()
+        if path == ['_cluster', 'health']:
+            self._send({'status': 'green'})
+        elif path == ['_benchmark', 'stats']:
+            self._send(self.stats)
+        elif path[-1] == '_bulk':
+            self._bulk(body)
+        elif path[:2] == ['_search', 'scroll']:
+            self._search_response([])
+        elif path[-1] == '_search':
+            self._search(path[0])
+        elif self.command == 'HEAD':
+            self._send({}, 200 if path[0] in self.indices else 404)
+        elif self.command == 'PUT' and len(path) == 1:
+            self.indices.setdefault(path[0], {})
+            self._send({'acknowledged': True})
+        else:
+            # Settings and mappings.
+            self._send({'acknowledged': True})
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = _handle
+
+
+def _run_fake_elasticsearch(conn):
+    server = HTTPServer(('127.0.0.1', 0), _FakeElasticsearchHandler)
+    conn.send(server.server_port)
+    server.serve_forever()
+
+
+def _start_fake_elasticsearch():
+    """Starts the fake in a separate process, so it doesn't compete with the
+    indexer for the GIL. Returns (process, url)."""
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_fake_elasticsearch,
+                                      args=(child_conn, ),
+                                      daemon=True)
+    process.start()
+    return process, 'http://127.0.0.1:%d' % parent_conn.recv()
+
+
+def _reset_peak_rss():
+    # On Linux, this resets VmHWM, so that peaks can be measured per stage.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _peak_rss_bytes():
+    """Returns peak RSS since the last _reset_peak_rss().
+
+    Where peak RSS can't be reset, returns peak RSS since the process started.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on Mac.
+    if platform.system() == 'Darwin':
+        return peak_rss
+    return peak_rss * 1024
+
+
+class _StageTimer(object):
+
+    def __init__(self, baseline_rss_bytes):
+        self.baseline_rss_bytes = baseline_rss_bytes
+        self.stages = []
+
+    def run(self, stage, table_name, num_rows, func, *args):
+        _reset_peak_rss()
+        start = time.time()
+        with metrics.span(stage, table=table_name):
+            func(*args)
+        seconds = time.time() - start
+        peak_rss_bytes = _peak_rss_bytes()
+        over_baseline_bytes = peak_rss_bytes - self.baseline_rss_bytes
+        result = {
+            'stage': stage,
+            'table': table_name,
+            'seconds': seconds,
+            'peak_rss_bytes': peak_rss_bytes,
+            'peak_rss_over_baseline_bytes': over_baseline_bytes,
+        }
+        if num_rows:
+            result['rows'] = num_rows
+            result['rows_per_sec'] = num_rows / seconds
+        self.stages.append(result)
+        logger.info('%s of %s took %.2f seconds.' %
+                    (stage, table_name, seconds))
+
+
+def main():
+    args = _parse_args()
+    if args.metrics:
+        metrics.enable()
+    fake_es_process = None
+    elasticsearch_url = args.elasticsearch_url
+    if not elasticsearch_url:
+        fake_es_process, elasticsearch_url = _start_fake_elasticsearch()
+
+    es = indexer_util.get_es_client(elasticsearch_url)
+    indexer_util.maybe_create_elasticsearch_index(es, elasticsearch_url,
+                                                  INDEX_NAME)
+    indexer_util.maybe_create_elasticsearch_index(es, elasticsearch_url,
+                                                  FIELDS_INDEX_NAME)
+    storage_client = _FakeStorageClient()
+    bq_client = _FakeBigQueryClient(storage_client, args.rows_per_shard)
+
+    # Generate all export files before timing anything.
+    tables = []
+    for table, time_series_vals in _synthetic_tables(args):
+        num_rows = bq_client.prepare_export(table)
+        tables.append((table, time_series_vals, num_rows))
+    # Memory used by the indexer is peak RSS during a stage minus RSS after
+    # setup, which includes the export files.
+    _reset_peak_rss()
+    baseline_rss_bytes = _peak_rss_bytes()
+
+    timer = _StageTimer(baseline_rss_bytes)
+    start = time.time()
+    total_rows = 0
+    for table, time_series_vals, num_rows in tables:
+        table_name = indexer._table_name_from_table(table)
+        total_rows += num_rows
+        timer.run('index_fields', table_name, 0, indexer.index_fields, es,
+                  FIELDS_INDEX_NAME, table, PARTICIPANT_ID_COLUMN,
+                  SAMPLE_ID_COLUMN, [])
+        timer.run('create_mappings', table_name, 0, indexer.create_mappings,
+                  es, INDEX_NAME, table_name, table.schema,
+                  PARTICIPANT_ID_COLUMN, SAMPLE_ID_COLUMN, SAMPLE_FILE_COLUMNS,
+                  TIME_SERIES_COLUMN, time_series_vals,
+                  args.time_series_layout)
+        timer.run('index_table', table_name, num_rows, indexer.index_table, es,
+                  bq_client, storage_client, INDEX_NAME, table,
+                  PARTICIPANT_ID_COLUMN, SAMPLE_ID_COLUMN, SAMPLE_FILE_COLUMNS,
+                  TIME_SERIES_COLUMN, time_series_vals,
+                  args.time_series_layout, None, False, DEPLOY_PROJECT_ID)
+    timer.run('create_samples_json_export_file', INDEX_NAME, 0,
+              indexer.create_samples_json_export_file, es, storage_client,
+              INDEX_NAME, DEPLOY_PROJECT_ID, SAMPLE_ID_COLUMN)
+    total_seconds = time.time() - start
+
+    samples_bucket = storage_client.lookup_bucket('%s-export-samples' %
+                                                  DEPLOY_PROJECT_ID)
+    samples_export_bytes = sum(
+        len(data) for data in samples_bucket.objects.values())
+    over_baseline_bytes = max(stage['peak_rss_over_baseline_bytes']
+                              for stage in timer.stages)
+    report = {
+        'config': vars(args),
+        'stages': timer.stages,
+        'total_seconds': total_seconds,
+        'total_rows': total_rows,
+        'rows_per_sec': total_rows / total_seconds,
+        'export_bytes': bq_client.bytes_exported,
+        'samples_export_bytes': samples_export_bytes,
+        'baseline_rss_bytes': baseline_rss_bytes,
+        'peak_rss_over_baseline_bytes': over_baseline_bytes,
+    }
+    if args.metrics:
+        report['metrics'] = metrics.report()
+    if fake_es_process:
+        es_stats = es.transport.perform_request('GET', '/_benchmark/stats')
+        report.update(es_stats)
+        fake_es_process.terminate()
+
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Compares the object and nested time series layouts.
+
+Creates one index per layout with a synthetic time series table, then reports
+indexing throughput, number of mapped fields and cluster state size for each
+index as JSON. Needs a running Elasticsearch, for example from bigquery
+directory: docker-compose up -d elasticsearch
+
+From bigquery directory, run:
+  python benchmark_time_series_layout.py --elasticsearch_url http://localhost:9200 \\
+    --num_columns 50 --num_time_points 100 --num_participants 1000
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import time
+
+from google.cloud import bigquery
+from indexer_util import indexer_util
+
+import indexer
+
+logger = logging.getLogger('indexer.bigquery.benchmark')
+
+TABLE_NAME = 'benchmark.time_series.table'
+PARTICIPANT_ID_COLUMN = 'participant_id'
+TIME_SERIES_COLUMN = 'time'
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--elasticsearch_url',
+                        type=str,
+                        help='Elasticsearch url. Must start with http://',
+                        default=os.environ.get('ELASTICSEARCH_URL'))
+    parser.add_argument('--index_prefix',
+                        type=str,
+                        default='benchmark_time_series_layout')
+    parser.add_argument('--num_columns', type=int, default=50)
+    parser.add_argument('--num_time_points', type=int, default=100)
+    parser.add_argument('--num_participants', type=int, default=1000)
+    return parser.parse_args()
+
+
+def _rows(num_columns, num_time_points, num_participants):
+    # Rows look like rows from a BigQuery JSON export. Use a fixed seed so both
+    # layouts index the same data.
+    rand = random.Random(0)
+    for t in range(num_time_points):
+        for p in range(num_participants):
+            row = {PARTICIPANT_ID_COLUMN: str(p), TIME_SERIES_COLUMN: str(t)}
+            for c in range(num_columns):
+                row['col_%d' % c] = rand.random()
+            yield row
+
+
+def _count_fields(properties):
+    count = 0
+    for entry in properties.values():
+        count += 1
+        count += _count_fields(entry.get('properties', {}))
+    return count
+
+
+def _benchmark_layout(es, elasticsearch_url, index_name, layout, args):
+    if es.indices.exists(index=index_name):
+        es.indices.delete(index=index_name)
+    indexer_util.maybe_create_elasticsearch_index(es, elasticsearch_url,
+                                                  index_name)
+
+    fields = [
+        bigquery.SchemaField(PARTICIPANT_ID_COLUMN, 'STRING'),
+        bigquery.SchemaField(TIME_SERIES_COLUMN, 'INTEGER')
+    ] + [
+        bigquery.SchemaField('col_%d' % c, 'FLOAT')
+        for c in range(args.num_columns)
+    ]
+    time_series_vals = [
+        indexer._encode_tsv(t) for t in range(args.num_time_points)
+    ]
+
+    start = time.time()
+    indexer.create_mappings(es, index_name, TABLE_NAME, fields,
+                            PARTICIPANT_ID_COLUMN, None, {},
+                            TIME_SERIES_COLUMN, time_series_vals, layout)
+    mapping_sec = time.time() - start
+
+    rows = _rows(args.num_columns, args.num_time_points, args.num_participants)
+    scripts_by_id = indexer._tsv_scripts_by_id(rows, TABLE_NAME,
+                                               PARTICIPANT_ID_COLUMN,
+                                               TIME_SERIES_COLUMN, int, layout)
+    start = time.time()
+    indexer_util.bulk_index_scripts(es, index_name, scripts_by_id)
+    indexing_sec = time.time() - start
+    num_rows = args.num_time_points * args.num_participants
+
+    properties = es.indices.get_mapping(
+        index=index_name)[index_name]['mappings']['type']['properties']
+    cluster_state = es.cluster.state(metric='metadata', index=index_name)
+    return {
+        'layout': layout,
+        'index': index_name,
+        'mapped_fields': _count_fields(properties),
+        'cluster_state_bytes': len(json.dumps(cluster_state)),
+        'create_mappings_sec': mapping_sec,
+        'indexing_sec': indexing_sec,
+        'rows_per_sec': num_rows / indexing_sec,
+    }
+
+
+def main():
+    args = _parse_args()
+    es = indexer_util.get_es_client(args.elasticsearch_url)
+    results = []
+    for layout in indexer.TIME_SERIES_LAYOUTS:
+        index_name = '%s_%s' % (args.index_prefix, layout)
+        logger.info('Benchmarking %s layout in %s.' % (layout, index_name))
+        results.append(
+            _benchmark_layout(es, args.elasticsearch_url, index_name, layout,
+                              args))
+    print(
+        json.dumps(
+            {
+                'num_columns': args.num_columns,
+                'num_time_points': args.num_time_points,
+                'num_participants': args.num_participants,
+                'results': results
+            },
+            indent=2))
+
+
+if __name__ == '__main__':
+    main()
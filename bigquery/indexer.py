@@ -1,9 +1,11 @@
 """Indexes BigQuery tables."""
 import argparse
+import concurrent.futures
 import json
 import logging
 import os
 import sys
+import threading
 import time
 import uuid
 
@@ -12,7 +14,11 @@ from google.cloud import bigquery
 from google.cloud import exceptions
 from google.cloud import storage
 
+from indexer_util import column_stats
 from indexer_util import indexer_util
+from indexer_util import metrics
+
+import local_source
 
 if sys.version_info.major < 3:
     raise Exception('Python2 is deprecated. Please upgrade to Python3')
@@ -55,6 +61,35 @@ for (Map.Entry entry : params.row.entrySet()) {
 }
 """
 
+# Used for the 'nested' time series layout. Each time series field holds a list
+# of {t, value} points instead of one object key per time series value.
+UPDATE_TSV_NESTED_SCRIPT = """
+for (Map.Entry entry : params.row.entrySet()) {
+   if (!ctx._source.containsKey(entry.getKey())) {
+      ctx._source.put(entry.getKey(), new ArrayList());
+   }
+   List points = ctx._source.get(entry.getKey());
+   // If there is already a point for this time, replace it.
+   points.removeIf(p -> p.get('t') == params.t);
+   points.add(['t': params.t, 'value': entry.getValue()]);
+}
+"""
+
+# Time series layouts; see time_series_layout in dataset_config/template/bigquery.json.
+# With the 'object' layout, each time series column is mapped to an object with
+# one sub-field per time series value, so the number of mapped fields grows as
+# columns x time points. With the 'nested' layout, each time series column is
+# mapped to a nested field with a fixed set of sub-fields.
+TIME_SERIES_LAYOUT_OBJECT = 'object'
+TIME_SERIES_LAYOUT_NESTED = 'nested'
+TIME_SERIES_LAYOUTS = [TIME_SERIES_LAYOUT_OBJECT, TIME_SERIES_LAYOUT_NESTED]
+# With the 'nested' layout, there is one nested field per time series column,
+# plus samples. Elasticsearch allows only 50 nested fields per index by default.
+NESTED_FIELDS_LIMIT = 10000
+
+# Maximum number of tables read concurrently by preflight().
+PREFLIGHT_MAX_WORKERS = 10
+
 
 # Copied from https://stackoverflow.com/a/45392259
 def _environ_or_required(key):
@@ -68,13 +103,67 @@ def _parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--elasticsearch_url',
                         type=str,
-                        help='Elasticsearch url. Must start with http://',
+                        help='Elasticsearch url. Must start with http://. '
+                        'Can be a comma-separated list of node urls.',
                         default=os.environ.get('ELASTICSEARCH_URL'))
+    parser.add_argument(
+        '--es_pool_maxsize',
+        type=int,
+        help='Number of connections kept open to each Elasticsearch node.',
+        default=int(
+            os.environ.get('ES_POOL_MAXSIZE', indexer_util.ES_POOL_MAXSIZE)))
+    parser.add_argument(
+        '--es_sniff',
+        action='store_true',
+        help='Find all nodes of the Elasticsearch cluster and spread requests '
+        'over them.',
+        default=os.environ.get('ES_SNIFF') == 'true')
+    parser.add_argument('--es_http_compress',
+                        action='store_true',
+                        help='Gzip Elasticsearch request bodies.',
+                        default=os.environ.get('ES_HTTP_COMPRESS') == 'true')
     parser.add_argument(
         '--dataset_config_dir',
         type=str,
-        help='Directory containing config files. Can be relative or absolute.',
-        default=os.environ.get('DATASET_CONFIG_DIR'))
+        nargs='+',
+        help='Directory containing config files, or a directory of such '
+        'directories. Can be relative or absolute. Can be repeated to index '
+        'several datasets in one run.',
+        default=os.environ.get('DATASET_CONFIG_DIR', '').split(','))
+    parser.add_argument(
+        '--local_data_dir',
+        type=str,
+        help='If set, read tables from files in this directory instead of '
+        'BigQuery. See local_source.py for the expected files.',
+        default=os.environ.get('LOCAL_DATA_DIR'))
+    parser.add_argument(
+        '--local_num_workers',
+        type=int,
+        help='Number of processes used to parse local NDJSON files.',
+        default=int(os.environ.get('LOCAL_NUM_WORKERS', os.cpu_count())))
+    parser.add_argument(
+        '--max_concurrent_datasets',
+        type=int,
+        help='Maximum number of datasets indexed at the same time.',
+        default=int(os.environ.get('MAX_CONCURRENT_DATASETS', 1)))
+    parser.add_argument(
+        '--shard_aware_bulk',
+        action='store_true',
+        help='Send bulk requests for table rows directly to the nodes holding '
+        'the primary shards of the documents, instead of to elasticsearch_url.',
+        default=os.environ.get('SHARD_AWARE_BULK') == 'true')
+    parser.add_argument(
+        '--metrics_report',
+        type=str,
+        help='If set, write a JSON report of time spent per table and stage, '
+        'counters and bulk latency to this file.',
+        default=os.environ.get('METRICS_REPORT'))
+    parser.add_argument(
+        '--metrics_textfile',
+        type=str,
+        help='If set, write the same metrics in Prometheus text format to this '
+        'file, eg for the node_exporter textfile collector.',
+        default=os.environ.get('METRICS_TEXTFILE'))
     return parser.parse_args()
 
 
@@ -96,11 +185,88 @@ def get_time_series_vals(bq_client, time_series_column, table_name, table):
 
     sql = 'SELECT DISTINCT %s from `%s`' % (time_series_column, table_name)
     query_job = bq_client.query(sql)
-    query_job.result()
-    if None in [row[time_series_column] for row in query_job]:
+    vals = [row[time_series_column] for row in query_job.result()]
+    return _encode_time_series_vals(vals, time_series_column, table_name)
+
+
+def _encode_time_series_vals(vals, time_series_column, table_name):
+    if None in vals:
         logger.warning('Table %s has null values in time series column %s' %
                        (table_name, time_series_column))
-    return [_encode_tsv(row[time_series_column]) for row in query_job]
+    return [_encode_tsv(val) for val in vals]
+
+
+def _get_local_time_series_vals(local_data_dir, local_pool, time_series_column,
+                                table_name, table):
+    # Like get_time_series_vals(), but reads the whole local table file.
+    if time_series_column not in [field.name for field in table.schema]:
+        return []
+    vals = local_source.distinct_values(local_data_dir, table_name,
+                                        time_series_column, local_pool)
+    return _encode_time_series_vals(list(vals), time_series_column, table_name)
+
+
+def _check_table_columns(table_name, table, participant_id_column,
+                         sample_id_column, time_series_column):
+    column_names = [field.name for field in table.schema]
+    if participant_id_column not in column_names:
+        raise Exception('Table %s does not have participant_id_column %s' %
+                        (table_name, participant_id_column))
+    if sample_id_column in column_names and time_series_column in column_names:
+        raise Exception(
+            'Table %s has both sample_id_column %s and time_series_column %s' %
+            (table_name, sample_id_column, time_series_column))
+
+
+def preflight(bq_client, index_name, table_names, participant_id_column,
+              sample_id_column, time_series_column, local_data_dir,
+              local_pool):
+    """Reads metadata and time series values of all tables, concurrently.
+
+    This is done before anything is exported or indexed, so that config errors
+    fail the run early.
+
+    Args:
+        bq_client: BigQuery client. Not used if local_data_dir is set.
+        index_name: Elasticsearch index name, for metrics labels. Worker
+            threads don't inherit the labels of the caller's span.
+        table_names: Fully-qualified BigQuery table names, from bigquery.json.
+        local_data_dir: If set, read tables from this directory instead of
+            BigQuery. See local_source.py.
+        local_pool: local_source.ParsePool used to parse local files.
+
+    Returns:
+        A list of (table name, table, time series values) tuples, in the same
+        order as table_names.
+    """
+
+    # Each local scan already keeps all workers of local_pool busy, so run
+    # them one at a time rather than queueing up ranges of several tables.
+    local_scan_lock = threading.Lock()
+
+    def preflight_table(table_name):
+        if local_data_dir:
+            table = local_source.read_table(local_data_dir, table_name)
+        else:
+            table = read_table(bq_client, table_name)
+        _check_table_columns(table_name, table, participant_id_column,
+                             sample_id_column, time_series_column)
+        with metrics.span('time_series_vals',
+                          index=index_name,
+                          table=table_name):
+            if local_data_dir:
+                with local_scan_lock:
+                    time_series_vals = _get_local_time_series_vals(
+                        local_data_dir, local_pool, time_series_column,
+                        table_name, table)
+            else:
+                time_series_vals = get_time_series_vals(
+                    bq_client, time_series_column, table_name, table)
+        return table_name, table, time_series_vals
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=PREFLIGHT_MAX_WORKERS) as executor:
+        return list(executor.map(preflight_table, table_names))
 
 
 def _table_name_from_table(table):
@@ -153,7 +319,10 @@ def _rows_from_export(
     for blob in bucket.list_blobs(prefix=export_obj_prefix):
         logger.info('Reading sharded BigQuery JSON export file: %s' %
                     blob.path)
-        json_text = blob.download_as_string().decode('utf-8')
+        with metrics.span('download_shard'):
+            data = blob.download_as_string()
+        metrics.inc('export_bytes', len(data))
+        json_text = data.decode('utf-8')
         for row in json_text.split('\n'):
             # Ignore any blank lines
             if not row:
@@ -182,12 +351,9 @@ def _rows_from_export(
 # In order to keep the center field, one must use a script. See
 # https://discuss.elastic.co/t/updating-nested-objects/87586/2 and
 # https://www.elastic.co/guide/en/elasticsearch/reference/6.4/docs-update.html
-def _sample_scripts_by_id_from_export(storage_client, bucket_name,
-                                      export_obj_prefix, table_name,
-                                      participant_id_column, sample_id_column,
-                                      sample_file_columns):
-    for row in _rows_from_export(storage_client, bucket_name,
-                                 export_obj_prefix):
+def _sample_scripts_by_id(rows, table_name, participant_id_column,
+                          sample_id_column, sample_file_columns):
+    for row in rows:
         participant_id = row[participant_id_column]
         del row[participant_id_column]
         row = {
@@ -217,10 +383,8 @@ def _sample_scripts_by_id_from_export(storage_client, bucket_name,
         }
 
 
-def _docs_by_id_from_export(storage_client, bucket_name, export_obj_prefix,
-                            table_name, participant_id_column):
-    for row in _rows_from_export(storage_client, bucket_name,
-                                 export_obj_prefix):
+def _docs_by_id(rows, table_name, participant_id_column):
+    for row in rows:
         participant_id = row[participant_id_column]
         # Document id is participant id; don't need it as a field.
         del row[participant_id_column]
@@ -233,29 +397,36 @@ def _docs_by_id_from_export(storage_client, bucket_name, export_obj_prefix,
         yield participant_id, row
 
 
-def _tsv_scripts_by_id_from_export(storage_client, bucket_name,
-                                   export_obj_prefix, table_name,
-                                   participant_id_column, time_series_column,
-                                   time_series_type):
-    for row in _rows_from_export(storage_client, bucket_name,
-                                 export_obj_prefix):
+def _tsv_scripts_by_id(rows, table_name, participant_id_column,
+                       time_series_column, time_series_type,
+                       time_series_layout):
+    for row in rows:
         participant_id = row[participant_id_column]
         del row[participant_id_column]
-        if time_series_column in row:
-            tsv = _encode_tsv(row[time_series_column], time_series_type)
-            del row[time_series_column]
-        else:
-            tsv = _encode_tsv(None, time_series_type)
+        tsv = row.pop(time_series_column, None)
         row = {'%s.%s' % (table_name, k): v for k, v in row.items()}
-        script = UPDATE_TSV_SCRIPT
-        yield participant_id, {
-            'source': script,
-            'lang': 'painless',
-            'params': {
-                'tsv': tsv,
-                'row': row
+        if time_series_layout == TIME_SERIES_LAYOUT_NESTED:
+            # Store the time itself rather than its encoded field name, so
+            # that range queries on t work. Unknown time is stored as null.
+            if tsv is not None:
+                tsv = time_series_type(tsv)
+            yield participant_id, {
+                'source': UPDATE_TSV_NESTED_SCRIPT,
+                'lang': 'painless',
+                'params': {
+                    't': tsv,
+                    'row': row
+                }
+            }
+        else:
+            yield participant_id, {
+                'source': UPDATE_TSV_SCRIPT,
+                'lang': 'painless',
+                'params': {
+                    'tsv': _encode_tsv(tsv, time_series_type),
+                    'row': row
+                }
             }
-        }
 
 
 def _create_table_from_view(bq_client, view):
@@ -285,7 +456,8 @@ def _create_table_from_view(bq_client, view):
 
 def index_table(es, bq_client, storage_client, index_name, table,
                 participant_id_column, sample_id_column, sample_file_columns,
-                time_series_column, time_series_vals, deploy_project_id):
+                time_series_column, time_series_vals, time_series_layout,
+                table_stats, shard_aware_bulk, deploy_project_id):
     table_name = _table_name_from_table(table)
     bucket_name = '%s-table-export' % deploy_project_id
     table_export_bucket = storage_client.lookup_bucket(bucket_name)
@@ -307,44 +479,84 @@ def index_table(es, bq_client, storage_client, index_name, table,
                     table_name)
         table = _create_table_from_view(bq_client, table)
 
-    job = bq_client.extract_table(
-        table,
-        # The '*'' enables file sharding, which is required for larger datasets.
-        'gs://%s/%s*.json' % (bucket_name, export_obj_prefix),
-        job_id=unique_id,
-        job_config=job_config)
-    # Wait up to 10 minutes for the resulting export files to be created.
-    job.result(timeout=600)
-    if sample_id_column in [f.name for f in table.schema]:
+    with metrics.span('extract_job'):
+        job = bq_client.extract_table(
+            table,
+            # The '*'' enables file sharding, which is required for larger datasets.
+            'gs://%s/%s*.json' % (bucket_name, export_obj_prefix),
+            job_id=unique_id,
+            job_config=job_config)
+        # Wait up to 10 minutes for the resulting export files to be created.
+        job.result(timeout=600)
+    rows = _rows_from_export(storage_client, bucket_name, export_obj_prefix)
+    index_rows(es, index_name, table_name, table.schema, rows,
+               participant_id_column, sample_id_column, sample_file_columns,
+               time_series_column, time_series_vals, time_series_layout,
+               table_stats, shard_aware_bulk)
+
+    if table_is_view:
+        # Delete the temporary copy table we created
+        bq_client.delete_table(table)
+        logger.info('Deleted temporary copy table %s' %
+                    _table_name_from_table(table))
+
+
+def index_rows(es, index_name, table_name, schema, rows, participant_id_column,
+               sample_id_column, sample_file_columns, time_series_column,
+               time_series_vals, time_series_layout, table_stats,
+               shard_aware_bulk):
+    """Indexes rows of a table into the main dataset index.
+
+    Args:
+        rows: Iterable of dicts, in the format of a BigQuery JSON export.
+    """
+    # Rows are read, transformed and sent to Elasticsearch lazily, as bulk()
+    # consumes the generators. Time each generator separately.
+    rows = metrics.timed_iter(rows, 'read_rows')
+    if table_stats:
+        rows = metrics.timed_iter(table_stats.add_rows(rows), 'column_stats')
+    if sample_id_column in [f.name for f in schema]:
         # Cannot have time series data for samples.
         assert not time_series_vals
-        scripts_by_id = _sample_scripts_by_id_from_export(
-            storage_client, bucket_name, export_obj_prefix, table_name,
-            participant_id_column, sample_id_column, sample_file_columns)
-        indexer_util.bulk_index_scripts(es, index_name, scripts_by_id)
+        scripts_by_id = _sample_scripts_by_id(rows, table_name,
+                                              participant_id_column,
+                                              sample_id_column,
+                                              sample_file_columns)
+        scripts_by_id = metrics.timed_iter(scripts_by_id, 'transform')
+        indexer_util.bulk_index_scripts(es, index_name, scripts_by_id,
+                                        shard_aware_bulk)
     elif time_series_vals:
-        assert time_series_column in [f.name for f in table.schema]
+        assert time_series_column in [f.name for f in schema]
         if time_series_vals[0] == 'Unknown' and len(time_series_vals) == 1:
             time_series_type = type(None)
         elif '_' in ''.join(time_series_vals):
             time_series_type = float
         else:
             time_series_type = int
-        scripts_by_id = _tsv_scripts_by_id_from_export(
-            storage_client, bucket_name, export_obj_prefix, table_name,
-            participant_id_column, time_series_column, time_series_type)
-        indexer_util.bulk_index_scripts(es, index_name, scripts_by_id)
+        scripts_by_id = _tsv_scripts_by_id(rows, table_name,
+                                           participant_id_column,
+                                           time_series_column,
+                                           time_series_type,
+                                           time_series_layout)
+        scripts_by_id = metrics.timed_iter(scripts_by_id, 'transform')
+        indexer_util.bulk_index_scripts(es, index_name, scripts_by_id,
+                                        shard_aware_bulk)
     else:
-        docs_by_id = _docs_by_id_from_export(storage_client, bucket_name,
-                                             export_obj_prefix, table_name,
-                                             participant_id_column)
-        indexer_util.bulk_index_docs(es, index_name, docs_by_id)
+        docs_by_id = _docs_by_id(rows, table_name, participant_id_column)
+        docs_by_id = metrics.timed_iter(docs_by_id, 'transform')
+        indexer_util.bulk_index_docs(es, index_name, docs_by_id,
+                                     shard_aware_bulk)
 
-    if table_is_view:
-        # Delete the temporary copy table we created
-        bq_client.delete_table(table)
-        logger.info('Deleted temporary copy table %s' %
-                    _table_name_from_table(table))
+
+def _field_id_prefix(table, sample_id_column):
+    id_prefix = _table_name_from_table(table)
+    # If the table contains the sample_id_columnm, prefix the elasticsearch Name
+    # of the fields in this table with "samples."
+    # This is needed to differentiate the sample facets for special handling.
+    for field in table.schema:
+        if field.name == sample_id_column:
+            id_prefix = "samples." + id_prefix
+    return id_prefix
 
 
 def index_fields(es, index_name, table, participant_id_column,
@@ -352,14 +564,8 @@ def index_fields(es, index_name, table, participant_id_column,
     table_name = _table_name_from_table(table)
     logger.info('Indexing %s into %s.' % (table_name, index_name))
 
-    id_prefix = table_name
+    id_prefix = _field_id_prefix(table, sample_id_column)
     fields = table.schema
-    # If the table contains the sample_id_columnm, prefix the elasticsearch Name
-    # of the fields in this table with "samples."
-    # This is needed to differentiate the sample facets for special handling.
-    for field in fields:
-        if field.name == sample_id_column:
-            id_prefix = "samples." + id_prefix
     # Use simple analyzer so underscores are treated as a word delimiter.
     # With default analyzer, searching for "baseline" would not find BQ column named "age_at_baseline".
     # With simple analyzer searching for "baseline" would find BQ column named "age_at_baseline".
@@ -386,16 +592,52 @@ def index_fields(es, index_name, table, participant_id_column,
                 },
                 'analyzer': 'simple'
             },
+            # Column statistics, see create_table_stats(). These are only
+            # looked up by field id, so don't index them.
+            'stats': {
+                'type': 'object',
+                'enabled': False
+            },
         }
     }
 
     field_docs = _field_docs_by_id(id_prefix, '', fields,
                                    participant_id_column, sample_id_column,
                                    columns_to_ignore)
-    es.indices.put_mapping(doc_type='type', index=index_name, body=mappings)
+    with metrics.span('update_mappings', index=index_name):
+        es.indices.put_mapping(doc_type='type',
+                               index=index_name,
+                               body=mappings)
     indexer_util.bulk_index_docs(es, index_name, field_docs)
 
 
+def create_table_stats(table, participant_id_column, sample_id_column,
+                       columns_to_ignore):
+    """Returns a TableStats for the columns of table in the fields index.
+
+    Only top-level, non-RECORD columns get statistics.
+    """
+    id_prefix = _field_id_prefix(table, sample_id_column)
+    columns = []
+    for field in table.schema:
+        if (field.name == participant_id_column
+                or field.name == sample_id_column
+                or field.name in columns_to_ignore
+                or field.field_type == 'RECORD'):
+            continue
+        is_numeric = _get_es_field_type(field.field_type,
+                                        field.mode) in ['long', 'float']
+        columns.append(
+            (field.name, '%s.%s' % (id_prefix, field.name), is_numeric))
+    return column_stats.TableStats(columns)
+
+
+def index_table_stats(es, index_name, table_stats):
+    # Partial updates, so name and description of field documents are kept.
+    indexer_util.bulk_index_docs(es, index_name,
+                                 table_stats.field_docs_by_id())
+
+
 def _get_es_field_type(bq_type, bq_mode):
     if bq_type == 'STRING':
         return 'text'
@@ -440,8 +682,26 @@ def _get_has_file_field_name(field_name, sample_file_columns):
     return ''
 
 
-def _add_field_to_mapping(properties, field_name, entry, time_series_vals):
-    if time_series_vals:
+def _add_field_to_mapping(properties, field_name, entry, time_series_vals,
+                          time_series_layout):
+    if time_series_vals and time_series_layout == TIME_SERIES_LAYOUT_NESTED:
+        # The number of mapped fields does not depend on the number of time
+        # series values.
+        properties[field_name] = {
+            'type': 'nested',
+            'properties': {
+                't': {
+                    'type': 'double'
+                },
+                'value': entry,
+                # See comment about _is_time_series below. With the nested
+                # layout, this is only set in the mapping, not in documents.
+                '_is_time_series': {
+                    'type': 'boolean'
+                }
+            }
+        }
+    elif time_series_vals:
         properties[field_name] = {
             'type': 'object',
             'properties': {tsv: entry
@@ -459,7 +719,7 @@ def _add_field_to_mapping(properties, field_name, entry, time_series_vals):
 
 def create_mappings(es, index_name, table_name, fields, participant_id_column,
                     sample_id_column, sample_file_columns, time_series_column,
-                    time_series_vals):
+                    time_series_vals, time_series_layout):
     # By default, Elasticsearch dynamically determines mappings while it ingests data.
     # Instead, we tell Elasticsearch the mappings before ingesting data; and we turn
     # dynamic mapping to false. For large datasets, this dramatically speeds up indexing.
@@ -495,12 +755,10 @@ def create_mappings(es, index_name, table_name, fields, participant_id_column,
         entry = {}
 
         if es_field_type == 'nested' or es_field_type == 'object':
-            inner_mappings = create_mappings(es, index_name, field.fields,
-                                             participant_id_column,
-                                             sample_id_column,
-                                             sample_file_columns,
-                                             time_series_column,
-                                             time_series_vals)
+            inner_mappings = create_mappings(
+                es, index_name, field.fields, participant_id_column,
+                sample_id_column, sample_file_columns, time_series_column,
+                time_series_vals, time_series_layout)
             properties[field_name]['properties'] = inner_mappings['properties']
         elif es_field_type == 'text':
             entry = {
@@ -523,17 +781,24 @@ def create_mappings(es, index_name, table_name, fields, participant_id_column,
 
         if entry:
             _add_field_to_mapping(properties, field_name, entry,
-                                  time_series_vals)
+                                  time_series_vals, time_series_layout)
 
         has_field_name = _get_has_file_field_name(field_name,
                                                   sample_file_columns)
         if has_field_name:
             _add_field_to_mapping(properties, has_field_name,
-                                  {'type': 'boolean'}, time_series_vals)
+                                  {'type': 'boolean'}, time_series_vals,
+                                  time_series_layout)
 
     # Default limit on total number of fields is too small for some datasets.
-    es.indices.put_settings({"index.mapping.total_fields.limit": 100000})
-    es.indices.put_mapping(doc_type='type', index=index_name, body=mappings)
+    settings = {"index.mapping.total_fields.limit": 100000}
+    if time_series_layout == TIME_SERIES_LAYOUT_NESTED:
+        settings['index.mapping.nested_fields.limit'] = NESTED_FIELDS_LIMIT
+    with metrics.span('update_mappings', index=index_name):
+        es.indices.put_settings(settings, index=index_name)
+        es.indices.put_mapping(doc_type='type',
+                               index=index_name,
+                               body=mappings)
 
 
 def read_table(bq_client, table_name):
@@ -600,50 +865,163 @@ def create_samples_json_export_file(es, storage_client, index_name,
     logger.info('Wrote gs://%s/%s' % (bucket_name, samples_file_name))
 
 
-def main():
-    args = _parse_args()
+def _deploy_project_id(dataset_config_dir):
+    deploy_config_path = os.path.join(dataset_config_dir, 'deploy.json')
+    return indexer_util.parse_json_file(deploy_config_path)['project_id']
+
+
+def _dataset_config_dirs(paths):
+    # Each path is either a dataset config directory, or a directory of them.
+    dataset_config_dirs = []
+    for path in paths:
+        if os.path.exists(os.path.join(path, 'dataset.json')):
+            dataset_config_dirs.append(path)
+            continue
+        subdirs = sorted(
+            os.path.join(path, d) for d in os.listdir(path)
+            if os.path.exists(os.path.join(path, d, 'dataset.json')))
+        if not subdirs:
+            raise Exception('No dataset config directories found in %s' % path)
+        dataset_config_dirs.extend(subdirs)
+    return dataset_config_dirs
+
+
+def index_dataset(es, elasticsearch_url, bq_client, storage_client,
+                  dataset_config_dir, shard_aware_bulk, local_data_dir,
+                  local_pool):
+    start = time.time()
     # Read dataset config files
-    index_name = indexer_util.get_index_name(args.dataset_config_dir)
+    index_name = indexer_util.get_index_name(dataset_config_dir)
     fields_index_name = '%s_fields' % index_name
-    bigquery_config_path = os.path.join(args.dataset_config_dir,
-                                        'bigquery.json')
+    bigquery_config_path = os.path.join(dataset_config_dir, 'bigquery.json')
     bigquery_config = indexer_util.parse_json_file(bigquery_config_path)
-    deploy_config_path = os.path.join(args.dataset_config_dir, 'deploy.json')
-    deploy_project_id = indexer_util.parse_json_file(
-        deploy_config_path)['project_id']
-    es = indexer_util.get_es_client(args.elasticsearch_url)
-    indexer_util.maybe_create_elasticsearch_index(es, args.elasticsearch_url,
-                                                  index_name)
-    indexer_util.maybe_create_elasticsearch_index(es, args.elasticsearch_url,
-                                                  fields_index_name)
+    deploy_project_id = _deploy_project_id(dataset_config_dir)
 
     participant_id_column = bigquery_config['participant_id_column']
     sample_id_column = bigquery_config.get('sample_id_column', None)
     sample_file_columns = bigquery_config.get('sample_file_columns', {})
     time_series_column = bigquery_config.get('time_series_column', None)
     columns_to_ignore = bigquery_config.get('columns_to_ignore', [])
-    bq_client = bigquery.Client(project=deploy_project_id)
-    storage_client = storage.Client(project=deploy_project_id)
-
-    for table_name in bigquery_config['table_names']:
-        table = read_table(bq_client, table_name)
-        time_series_vals = get_time_series_vals(bq_client, time_series_column,
-                                                table_name, table)
-        index_fields(es, fields_index_name, table, participant_id_column,
-                     sample_id_column, columns_to_ignore)
-        create_mappings(es, index_name, table_name, table.schema,
-                        participant_id_column, sample_id_column,
-                        sample_file_columns, time_series_column,
-                        time_series_vals)
-        index_table(es, bq_client, storage_client, index_name, table,
-                    participant_id_column, sample_id_column,
-                    sample_file_columns, time_series_column, time_series_vals,
-                    deploy_project_id)
-
-    # Ensure all of the newly indexed documents are loaded into ES.
-    time.sleep(5)
-    create_samples_json_export_file(es, storage_client, index_name,
-                                    deploy_project_id, sample_id_column)
+    compute_column_stats = bigquery_config.get('compute_column_stats', False)
+    time_series_layout = bigquery_config.get('time_series_layout',
+                                             TIME_SERIES_LAYOUT_OBJECT)
+    if time_series_layout not in TIME_SERIES_LAYOUTS:
+        raise Exception('Invalid time_series_layout %s, must be one of %s' %
+                        (time_series_layout, TIME_SERIES_LAYOUTS))
+    with metrics.span('preflight', index=index_name):
+        tables = preflight(bq_client, index_name,
+                           bigquery_config['table_names'],
+                           participant_id_column, sample_id_column,
+                           time_series_column, local_data_dir, local_pool)
+
+    indexer_util.maybe_create_elasticsearch_index(es, elasticsearch_url,
+                                                  index_name)
+    indexer_util.maybe_create_elasticsearch_index(es, elasticsearch_url,
+                                                  fields_index_name)
+
+    for i, (table_name, table, time_series_vals) in enumerate(tables):
+        logger.info('Indexing table %d/%d of %s: %s' %
+                    (i + 1, len(tables), index_name, table_name))
+        with metrics.span('table', index=index_name, table=table_name):
+            index_fields(es, fields_index_name, table, participant_id_column,
+                         sample_id_column, columns_to_ignore)
+            create_mappings(es, index_name, table_name, table.schema,
+                            participant_id_column, sample_id_column,
+                            sample_file_columns, time_series_column,
+                            time_series_vals, time_series_layout)
+            table_stats = None
+            if compute_column_stats:
+                table_stats = create_table_stats(table, participant_id_column,
+                                                 sample_id_column,
+                                                 columns_to_ignore)
+            if local_data_dir:
+                rows = local_source.rows(local_data_dir, table_name,
+                                         local_pool)
+                index_rows(es, index_name, table_name, table.schema, rows,
+                           participant_id_column, sample_id_column,
+                           sample_file_columns, time_series_column,
+                           time_series_vals, time_series_layout, table_stats,
+                           shard_aware_bulk)
+            else:
+                index_table(es, bq_client, storage_client, index_name, table,
+                            participant_id_column, sample_id_column,
+                            sample_file_columns, time_series_column,
+                            time_series_vals, time_series_layout, table_stats,
+                            shard_aware_bulk, deploy_project_id)
+            if table_stats:
+                index_table_stats(es, fields_index_name, table_stats)
+
+    if local_data_dir:
+        # Local runs don't need GCP, so don't write to GCS.
+        logger.info('Not writing samples export file for local data.')
+    else:
+        with metrics.span('samples_export', index=index_name):
+            # Ensure all of the newly indexed documents are loaded into ES.
+            time.sleep(5)
+            create_samples_json_export_file(es, storage_client, index_name,
+                                            deploy_project_id,
+                                            sample_id_column)
+    logger.info('Indexed %s in %d seconds.' %
+                (index_name, time.time() - start))
+
+
+def main():
+    args = _parse_args()
+    if args.metrics_report or args.metrics_textfile:
+        metrics.enable()
+    dataset_config_dirs = _dataset_config_dirs(args.dataset_config_dir)
+    # All datasets share one Elasticsearch client, and so its connection pool.
+    es = indexer_util.get_es_client(args.elasticsearch_url,
+                                    pool_maxsize=args.es_pool_maxsize,
+                                    sniff=args.es_sniff,
+                                    http_compress=args.es_http_compress)
+    # Datasets deployed to the same project share BigQuery and GCS clients.
+    # Local runs don't use them.
+    clients_by_project_id = {}
+    for dataset_config_dir in dataset_config_dirs:
+        project_id = _deploy_project_id(dataset_config_dir)
+        if project_id not in clients_by_project_id and not args.local_data_dir:
+            bq_client = bigquery.Client(project=project_id)
+            storage_client = storage.Client(project=project_id)
+            clients_by_project_id[project_id] = (bq_client, storage_client)
+    # All local reads share one pool of parser processes.
+    local_pool = None
+    if args.local_data_dir:
+        local_pool = local_source.ParsePool(args.local_num_workers)
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.max_concurrent_datasets) as executor:
+        futures = {}
+        for dataset_config_dir in dataset_config_dirs:
+            bq_client, storage_client = clients_by_project_id.get(
+                _deploy_project_id(dataset_config_dir), (None, None))
+            future = executor.submit(index_dataset, es, args.elasticsearch_url,
+                                     bq_client, storage_client,
+                                     dataset_config_dir, args.shard_aware_bulk,
+                                     args.local_data_dir, local_pool)
+            futures[future] = dataset_config_dir
+        # Keep indexing the other datasets if one fails.
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+            done += 1
+            progress = '%d/%d datasets done' % (done, len(futures))
+            try:
+                future.result()
+                logger.info('Finished %s (%s).' % (futures[future], progress))
+            except Exception:
+                logger.exception('Failed to index %s (%s).' %
+                                 (futures[future], progress))
+                failed.append(futures[future])
+    if local_pool:
+        local_pool.close()
+    # Write metrics even if some datasets failed; that's when they're useful.
+    if args.metrics_report:
+        metrics.write_report(args.metrics_report)
+    if args.metrics_textfile:
+        metrics.write_prometheus_textfile(args.metrics_textfile)
+    if failed:
+        raise Exception('Failed to index datasets: %s' % failed)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+"""Reads tables from local files instead of BigQuery.
+
+For each table in bigquery.json, the local data directory must have:
+- <table name>.schema.json: The BigQuery table schema, as written by
+  bq show --schema --format=prettyjson <project id>:<dataset id>.<table name>
+- Either <table name>.json: Newline-delimited JSON, as written by a BigQuery
+  extract job with NEWLINE_DELIMITED_JSON format (shards can be concatenated).
+  Or <table name>.parquet: A Parquet file. Reading Parquet requires pyarrow.
+Table name is the fully-qualified name from bigquery.json, eg
+verily-public-data.human_genome_variants.1000_genomes_sample_info.
+"""
+
+import collections
+import datetime
+import decimal
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+
+from google.cloud import bigquery
+
+from indexer_util import indexer_util
+
+logger = logging.getLogger('indexer.bigquery.local')
+
+# NDJSON files are split into byte ranges of about this size, which are parsed
+# by worker processes.
+NDJSON_RANGE_BYTES = 16 * 1024 * 1024
+PARQUET_BATCH_SIZE = 10000
+
+
+class LocalTable(object):
+    """Has the attributes of google.cloud.bigquery.Table used by indexer.py."""
+
+    def __init__(self, table_name, schema):
+        # Use rsplit instead of split because project id may have ".", eg
+        # "google.com:api-project-123".
+        project_id, dataset_id, table_id = table_name.rsplit('.', 2)
+        # Legacy format, like bigquery.Table.full_table_id.
+        self.full_table_id = '%s:%s.%s' % (project_id, dataset_id, table_id)
+        self.schema = schema
+        self.table_type = 'TABLE'
+
+
+def read_table(local_data_dir, table_name):
+    schema_path = os.path.join(local_data_dir, '%s.schema.json' % table_name)
+    schema = [
+        bigquery.SchemaField.from_api_repr(field)
+        for field in indexer_util.parse_json_file(schema_path)
+    ]
+    return LocalTable(table_name, schema)
+
+
+class ParsePool(object):
+    """Worker processes that parse NDJSON files, shared by all reads of a run.
+
+    Creating a pool per read would start up to num_workers processes for each
+    table read concurrently. Workers are started with forkserver where
+    available, because the indexer is multithreaded and fork is not
+    thread-safe.
+    """
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self._pool = None
+        if num_workers > 1:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context('spawn')
+            self._pool = context.Pool(num_workers)
+
+    def apply_async(self, func, args):
+        return self._pool.apply_async(func, args)
+
+    def close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _ndjson_ranges(mm, range_bytes):
+    # Splits mm into (start, end) ranges that end on a line boundary.
+    start = 0
+    while start < len(mm):
+        end = mm.find(b'\n', start + range_bytes)
+        end = len(mm) if end == -1 else end + 1
+        yield start, end
+        start = end
+
+
+def _parse_ndjson_range(path, start, end):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            lines = mm[start:end].split(b'\n')
+    # Ignore any blank lines
+    return [json.loads(line) for line in lines if line]
+
+
+def _rows_from_ndjson(path, pool):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ranges = list(_ndjson_ranges(mm, NDJSON_RANGE_BYTES))
+    logger.info('Reading %s in %d ranges with %d workers.' %
+                (path, len(ranges), pool.num_workers))
+    if pool.num_workers <= 1 or len(ranges) == 1:
+        for start, end in ranges:
+            for row in _parse_ndjson_range(path, start, end):
+                yield row
+        return
+
+    # Keep only a few parsed ranges in memory at a time, and yield rows in
+    # file order.
+    pending = collections.deque()
+    for start, end in ranges:
+        pending.append(
+            pool.apply_async(_parse_ndjson_range, (path, start, end)))
+        if len(pending) > 2 * pool.num_workers:
+            for row in pending.popleft().get():
+                yield row
+    while pending:
+        for row in pending.popleft().get():
+            yield row
+
+
+def _json_value(value):
+    # Converts Parquet values to what a BigQuery JSON export would have.
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo:
+            value = value.astimezone(datetime.timezone.utc)
+            return value.strftime('%Y-%m-%d %H:%M:%S UTC')
+        return value.strftime('%Y-%m-%dT%H:%M:%S')
+    elif isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, decimal.Decimal):
+        return float(value)
+    elif isinstance(value, dict):
+        return {k: _json_value(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_json_value(v) for v in value]
+    return value
+
+
+def _rows_from_parquet(path):
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Reading %s requires pyarrow: pip install pyarrow' %
+                          path)
+    logger.info('Reading %s.' % path)
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=PARQUET_BATCH_SIZE):
+        for row in batch.to_pylist():
+            # Null values are left out of BigQuery JSON exports.
+            yield {k: _json_value(v) for k, v in row.items() if v is not None}
+
+
+def rows(local_data_dir, table_name, pool):
+    """Yields rows of a table as dicts, like rows of a BigQuery JSON export.
+
+    Args:
+        local_data_dir: Directory with table files.
+        table_name: Fully-qualified table name from bigquery.json.
+        pool: ParsePool used to parse NDJSON files.
+    """
+    parquet_path = os.path.join(local_data_dir, '%s.parquet' % table_name)
+    if os.path.exists(parquet_path):
+        return _rows_from_parquet(parquet_path)
+    ndjson_path = os.path.join(local_data_dir, '%s.json' % table_name)
+    if os.path.exists(ndjson_path):
+        return _rows_from_ndjson(ndjson_path, pool)
+    raise Exception('Neither %s nor %s exist' % (parquet_path, ndjson_path))
+
+
+def distinct_values(local_data_dir, table_name, column, pool):
+    """Returns the distinct values of column. Null is returned as None."""
+    return set(
+        row.get(column) for row in rows(local_data_dir, table_name, pool))
@@ -0,0 +1,165 @@
+"""Migrates an index from the 'object' to the 'nested' time series layout.
+
+Time series fields in the source index look like:
+  "table.GLUCOSE": {"_is_time_series": true, "1": 79, "2": 78}
+In the destination index, they look like:
+  "table.GLUCOSE": [{"t": 1, "value": 79}, {"t": 2, "value": 78}]
+
+Documents are copied server-side with the Elasticsearch reindex API, so the
+dataset does not have to be exported from BigQuery again. The source index is
+left untouched. Once the destination index has been checked, delete the source
+index and set "time_series_layout": "nested" in bigquery.json so that future
+indexer runs use the new layout.
+
+From bigquery directory, run:
+  python migrate_time_series_layout.py --elasticsearch_url http://localhost:9200 \\
+    --source_index framingham_heart_study_teaching_dataset \\
+    --dest_index framingham_heart_study_teaching_dataset_nested
+"""
+import argparse
+import logging
+import os
+
+from indexer_util import indexer_util
+
+import indexer
+
+logger = logging.getLogger('indexer.bigquery.migrate')
+
+OBJECT_TO_NESTED_SCRIPT = """
+for (String field : params.time_series_fields) {
+   if (!ctx._source.containsKey(field)) {
+      continue;
+   }
+   List points = new ArrayList();
+   for (Map.Entry entry : ctx._source.get(field).entrySet()) {
+      if (entry.getKey() == '_is_time_series') {
+         continue;
+      }
+      // Reverse _encode_tsv() in indexer.py.
+      Double t = null;
+      if (entry.getKey() != 'Unknown') {
+         t = Double.parseDouble(entry.getKey().replace('_', '.'));
+      }
+      points.add(['t': t, 'value': entry.getValue()]);
+   }
+   ctx._source.put(field, points);
+}
+"""
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--elasticsearch_url',
+                        type=str,
+                        help='Elasticsearch url. Must start with http://',
+                        default=os.environ.get('ELASTICSEARCH_URL'))
+    parser.add_argument('--source_index',
+                        type=str,
+                        required=True,
+                        help='Index using the object time series layout.')
+    parser.add_argument('--dest_index',
+                        type=str,
+                        required=True,
+                        help='Index to create with the nested layout.')
+    return parser.parse_args()
+
+
+def nested_layout_properties(properties, path=''):
+    """Converts object layout mapping properties to nested layout properties.
+
+    get_mapping() returns dotted field names, like
+    "verily-public-data.dataset.table.GLUCOSE", as a tree of objects, so this
+    walks the tree.
+
+    Args:
+        properties: 'properties' of an index mapping created with the object
+            time series layout.
+        path: Dotted name of the object that has properties, plus '.'.
+
+    Returns:
+        A tuple of (new properties, full dotted names of time series fields).
+        Field names in _source are full dotted names.
+    """
+    new_properties = {}
+    time_series_fields = []
+    for field_name, entry in properties.items():
+        sub_properties = entry.get('properties', {})
+        if '_is_time_series' in sub_properties:
+            time_series_vals = [
+                tsv for tsv in sub_properties if tsv != '_is_time_series'
+            ]
+            # All time series values of a field have the same mapping.
+            value_entry = sub_properties[time_series_vals[0]]
+            indexer._add_field_to_mapping(new_properties, field_name,
+                                          value_entry, time_series_vals,
+                                          indexer.TIME_SERIES_LAYOUT_NESTED)
+            time_series_fields.append(path + field_name)
+        elif sub_properties and entry.get('type', 'object') == 'object':
+            # Nested fields, like samples, don't have time series data.
+            new_sub_properties, sub_time_series_fields = (
+                nested_layout_properties(sub_properties,
+                                         '%s%s.' % (path, field_name)))
+            new_properties[field_name] = dict(entry,
+                                              properties=new_sub_properties)
+            time_series_fields.extend(sub_time_series_fields)
+        else:
+            new_properties[field_name] = entry
+    return new_properties, time_series_fields
+
+
+def migrate(es, elasticsearch_url, source_index, dest_index):
+    mappings = es.indices.get_mapping(
+        index=source_index)[source_index]['mappings']['type']
+    properties, time_series_fields = nested_layout_properties(
+        mappings['properties'])
+    logger.info('Converting %d time series fields from %s into %s.' %
+                (len(time_series_fields), source_index, dest_index))
+
+    indexer_util.maybe_create_elasticsearch_index(es, elasticsearch_url,
+                                                  dest_index)
+    # Same settings as indexer.create_mappings().
+    es.indices.put_settings(
+        {
+            'index.mapping.total_fields.limit': 100000,
+            'index.mapping.nested_fields.limit': indexer.NESTED_FIELDS_LIMIT,
+        },
+        index=dest_index)
+    es.indices.put_mapping(doc_type='type',
+                           index=dest_index,
+                           body={
+                               'dynamic': False,
+                               'properties': properties
+                           })
+    result = es.reindex(body={
+        'source': {
+            'index': source_index
+        },
+        'dest': {
+            'index': dest_index
+        },
+        'script': {
+            'source': OBJECT_TO_NESTED_SCRIPT,
+            'lang': 'painless',
+            'params': {
+                'time_series_fields': time_series_fields
+            }
+        }
+    },
+                        wait_for_completion=True,
+                        request_timeout=3600)
+    if result['failures']:
+        raise Exception('Failed to migrate %s: %s' %
+                        (source_index, result['failures']))
+    logger.info('Migrated %d documents from %s into %s.' %
+                (result['total'], source_index, dest_index))
+
+
+def main():
+    args = _parse_args()
+    es = indexer_util.get_es_client(args.elasticsearch_url)
+    migrate(es, args.elasticsearch_url, args.source_index, args.dest_index)
+
+
+if __name__ == '__main__':
+    main()
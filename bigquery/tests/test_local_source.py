@@ -0,0 +1,23 @@
+"""Tests for local_source.py.
+
+From bigquery directory, run: python -m unittest discover tests
+"""
+import unittest
+
+import indexer
+import local_source
+
+
+class LocalTableTest(unittest.TestCase):
+
+    def test_table_name_round_trips(self):
+        for table_name in [
+                'verily-public-data.human_genome_variants.1000_genomes_sample_info',
+                'google.com:api-project-123.dataset.table',
+        ]:
+            table = local_source.LocalTable(table_name, [])
+            self.assertEqual(table_name, indexer._table_name_from_table(table))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Tests for migrate_time_series_layout.py.
+
+From bigquery directory, run: python -m unittest discover tests
+"""
+import json
+import os
+import unittest
+
+import migrate_time_series_layout
+
+TABLE_NAME = ('verily-public-data.framingham_heart_study_teaching.'
+              'framingham_heart_study_teaching')
+MAPPINGS_GOLDEN = os.path.join(
+    os.path.dirname(__file__),
+    'framingham_heart_study_teaching_dataset_mappings_golden.json')
+
+
+class NestedLayoutPropertiesTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(MAPPINGS_GOLDEN) as f:
+            golden = json.load(f)
+        self.properties = golden['framingham_heart_study_teaching_dataset'][
+            'mappings']['type']['properties']
+        self.table_properties = self.properties['verily-public-data'][
+            'properties']['framingham_heart_study_teaching']['properties'][
+                'framingham_heart_study_teaching']['properties']
+
+    def test_converts_all_time_series_fields(self):
+        properties, time_series_fields = (
+            migrate_time_series_layout.nested_layout_properties(
+                self.properties))
+
+        expected_columns = [
+            column for column, entry in self.table_properties.items()
+            if '_is_time_series' in entry.get('properties', {})
+        ]
+        self.assertEqual(39, len(expected_columns))
+        # _source keys are full dotted names.
+        self.assertEqual(
+            sorted('%s.%s' % (TABLE_NAME, column)
+                   for column in expected_columns), sorted(time_series_fields))
+
+        new_table_properties = properties['verily-public-data']['properties'][
+            'framingham_heart_study_teaching']['properties'][
+                'framingham_heart_study_teaching']['properties']
+        for column in expected_columns:
+            entry = new_table_properties[column]
+            self.assertEqual('nested', entry['type'])
+            self.assertEqual({'t', 'value', '_is_time_series'},
+                             set(entry['properties']))
+            # The value mapping is the mapping of the old per-time fields.
+            self.assertEqual(self.table_properties[column]['properties']['1'],
+                             entry['properties']['value'])
+
+    def test_keeps_other_fields(self):
+        properties, _ = migrate_time_series_layout.nested_layout_properties(
+            self.properties)
+
+        new_table_properties = properties['verily-public-data']['properties'][
+            'framingham_heart_study_teaching']['properties'][
+                'framingham_heart_study_teaching']['properties']
+        self.assertEqual(set(self.table_properties), set(new_table_properties))
+        for column, entry in self.table_properties.items():
+            if '_is_time_series' not in entry.get('properties', {}):
+                self.assertEqual(entry, new_table_properties[column])
+        for field_name in self.properties:
+            self.assertIn(field_name, properties)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+"""Column statistics computed in a single pass over table rows.
+
+Memory used per column is bounded and does not depend on the number of rows:
+distinct counts use a HyperLogLog sketch, quantiles use a fixed-size reservoir
+sample and top values use the Space-Saving algorithm.
+"""
+
+import hashlib
+import math
+import random
+
+# 2^12 one-byte registers; standard error is about 1.6%.
+HLL_PRECISION = 12
+RESERVOIR_SIZE = 1000
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+TOP_K = 10
+# Number of counters kept for top values. Keeping more counters than values
+# reported makes the reported counts more accurate.
+TOP_K_CAPACITY = 100
+
+
+class HyperLogLog(object):
+    """Estimates the number of distinct values added."""
+
+    def __init__(self, precision=HLL_PRECISION):
+        self._precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode('utf-8'),
+                                 digest_size=8).digest()
+        h = int.from_bytes(digest, 'big')
+        # First bits select the register; the rest give the rank.
+        idx = h >> (64 - self._precision)
+        w = h & ((1 << (64 - self._precision)) - 1)
+        rank = (64 - self._precision) - w.bit_length() + 1
+        if rank > self._registers[idx]:
+            self._registers[idx] = rank
+
+    def count(self):
+        m = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-r for r in self._registers)
+        zeros = self._registers.count(0)
+        # Use linear counting for small cardinalities.
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+class Reservoir(object):
+    """Keeps a uniform random sample of the values added."""
+
+    def __init__(self, size=RESERVOIR_SIZE):
+        self._size = size
+        self._num_added = 0
+        self._values = []
+        # Fixed seed so that reindexing the same table gives the same stats.
+        self._random = random.Random(0)
+
+    def add(self, value):
+        self._num_added += 1
+        if len(self._values) < self._size:
+            self._values.append(value)
+        else:
+            i = self._random.randrange(self._num_added)
+            if i < self._size:
+                self._values[i] = value
+
+    def quantiles(self, qs=QUANTILES):
+        """Returns a dict from quantile name (eg "p50") to value."""
+        if not self._values:
+            return {}
+        values = sorted(self._values)
+        quantiles = {}
+        for q in qs:
+            i = min(int(q * len(values)), len(values) - 1)
+            quantiles['p%d' % round(q * 100)] = values[i]
+        return quantiles
+
+
+class TopK(object):
+    """Keeps approximate counts of the most frequent values (Space-Saving)."""
+
+    def __init__(self, capacity=TOP_K_CAPACITY):
+        self._capacity = capacity
+        self._counts = {}
+
+    def add(self, value):
+        if value in self._counts:
+            self._counts[value] += 1
+        elif len(self._counts) < self._capacity:
+            self._counts[value] = 1
+        else:
+            # Replace the least frequent value. The new value inherits its
+            # count, so counts are overestimates.
+            least = min(self._counts, key=self._counts.get)
+            self._counts[value] = self._counts.pop(least) + 1
+
+    def top(self, k=TOP_K):
+        top = sorted(self._counts.items(), key=lambda kv: -kv[1])[:k]
+        return [{'value': value, 'count': count} for value, count in top]
+
+
+class ColumnStats(object):
+    """Statistics of a single column."""
+
+    def __init__(self, is_numeric):
+        self._is_numeric = is_numeric
+        self._count = 0
+        self._min = None
+        self._max = None
+        self._distinct = HyperLogLog()
+        if is_numeric:
+            self._reservoir = Reservoir()
+        else:
+            self._top_k = TopK()
+
+    def add(self, value):
+        self._count += 1
+        self._distinct.add(value)
+        if not self._is_numeric:
+            self._top_k.add(value)
+            return
+        # BigQuery JSON exports have integers as strings, and FLOAT columns can
+        # have Infinity.
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        if not math.isfinite(value):
+            return
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+        self._reservoir.add(value)
+
+    def to_dict(self, num_rows):
+        stats = {
+            'count': self._count,
+            'null_count': num_rows - self._count,
+            'approx_distinct_count': self._distinct.count(),
+        }
+        if self._is_numeric:
+            if self._min is not None:
+                stats['min'] = self._min
+                stats['max'] = self._max
+            stats['approx_quantiles'] = self._reservoir.quantiles()
+        else:
+            stats['top_values'] = self._top_k.top()
+        return stats
+
+
+class TableStats(object):
+    """Statistics of the columns of one table."""
+
+    def __init__(self, columns):
+        """
+        Args:
+            columns: A list of (column name, field id, is numeric) tuples.
+                Field id is the id of the column's document in the fields
+                index.
+        """
+        self._num_rows = 0
+        self._columns = [(name, field_id, ColumnStats(is_numeric))
+                         for name, field_id, is_numeric in columns]
+
+    def add_row(self, row):
+        self._num_rows += 1
+        for name, _, column_stats in self._columns:
+            # Null values are left out of BigQuery JSON exports.
+            value = row.get(name)
+            # Only scalar values are counted.
+            if value is not None and not isinstance(value, (dict, list)):
+                column_stats.add(value)
+
+    def add_rows(self, rows):
+        """Adds rows to the statistics, and yields them unchanged."""
+        for row in rows:
+            self.add_row(row)
+            yield row
+
+    def field_docs_by_id(self):
+        """Yields (field id, partial fields index document) tuples."""
+        for _, field_id, column_stats in self._columns:
+            yield field_id, {'stats': column_stats.to_dict(self._num_rows)}
@@ -1,14 +1,23 @@
 """Utilities for Data Explorer indexers"""
 
+import gzip
 import jsmin
 import json
 import logging
 import os
+import socket
+import threading
 import time
+import weakref
 
 from elasticsearch import Elasticsearch
+from elasticsearch import Urllib3HttpConnection
 from elasticsearch.exceptions import ConnectionError
 from elasticsearch.helpers import bulk
+from elasticsearch.transport import get_host_info
+from urllib3.connection import HTTPConnection
+
+from indexer_util import metrics
 
 # Log to stderr.
 logging.basicConfig(
@@ -18,6 +27,27 @@ logging.basicConfig(
 logger = logging.getLogger('indexer.util')
 
 ES_TIMEOUT_SEC = 20
+# Number of actions per bulk request. This is the default of
+# elasticsearch.helpers.bulk.
+BULK_CHUNK_SIZE = 500
+# Default number of connections kept open to each Elasticsearch node. This
+# should be at least the number of concurrent bulk requests.
+ES_POOL_MAXSIZE = 10
+# With sniffing, how often to refresh the list of nodes.
+ES_SNIFFER_TIMEOUT_SEC = 300
+# How long a failed node is skipped for. This doubles with each consecutive
+# failure, up to 2^5 times.
+ES_DEAD_TIMEOUT_SEC = 30
+
+# Indexing a large table takes hours. Turn on TCP keep-alive so idle pooled
+# connections aren't silently dropped by NAT or load balancers in between.
+_KEEPALIVE_SOCKET_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for _name, _value in [('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10),
+                      ('TCP_KEEPCNT', 6)]:
+    # These are not defined on all platforms, eg TCP_KEEPIDLE on Mac.
+    if hasattr(socket, _name):
+        _KEEPALIVE_SOCKET_OPTIONS.append(
+            (socket.IPPROTO_TCP, getattr(socket, _name), _value))
 
 
 def parse_json_file(json_path):
@@ -88,14 +118,110 @@ def _wait_elasticsearch_healthy(es):
     logging.getLogger("elasticsearch").setLevel(logging.INFO)
 
 
-def get_es_client(elasticsearch_url):
+class _KeepAliveHttpConnection(Urllib3HttpConnection):
+    """Urllib3HttpConnection with TCP keep-alive and gzipped request bodies.
+
+    elasticsearch-py 6.1 doesn't support compressing requests, so do it here.
+    Elasticsearch decompresses requests with Content-Encoding: gzip.
+    """
+
+    def __init__(self, http_compress=False, **kwargs):
+        super(_KeepAliveHttpConnection, self).__init__(**kwargs)
+        self.http_compress = http_compress
+        self.pool.conn_kw['socket_options'] = (
+            HTTPConnection.default_socket_options + _KEEPALIVE_SOCKET_OPTIONS)
+        if http_compress:
+            self.headers['accept-encoding'] = 'gzip'
+
+    def perform_request(self,
+                        method,
+                        url,
+                        params=None,
+                        body=None,
+                        timeout=None,
+                        ignore=(),
+                        headers=None):
+        if self.http_compress and body:
+            body = gzip.compress(body)
+            headers = dict(headers or {})
+            headers['content-encoding'] = 'gzip'
+        perform_request = super(_KeepAliveHttpConnection, self).perform_request
+        if not metrics.enabled() or not url.endswith('/_bulk'):
+            return perform_request(method, url, params, body, timeout, ignore,
+                                   headers)
+
+        metrics.inc('bulk_requests')
+        metrics.inc('bulk_request_bytes', len(body))
+        start = time.perf_counter()
+        try:
+            status, response_headers, data = perform_request(
+                method, url, params, body, timeout, ignore, headers)
+        except Exception:
+            # Counts every failed request, including the last one. Transport
+            # retries connection errors, timeouts and 502/503/504 responses up
+            # to max_retries times; other errors fail the bulk request.
+            metrics.inc('bulk_request_failures')
+            raise
+        finally:
+            metrics.observe('bulk_request_seconds',
+                            time.perf_counter() - start)
+        # Only parse the response if some actions failed.
+        if '"errors":true' in data:
+            for item in json.loads(data)['items']:
+                item_status = list(item.values())[0]['status']
+                # 429 means the node's bulk queue was full.
+                if item_status == 429:
+                    metrics.inc('bulk_rejections')
+                elif item_status >= 300:
+                    metrics.inc('bulk_item_errors')
+        return status, response_headers, data
+
+
+def _sniffed_host_info(node_info, host):
+    # Starting with Elasticsearch 7, publish_address looks like
+    # "es-data-0/10.0.0.5:9200".
+    host['host'] = host['host'].split('/')[-1]
+    return get_host_info(node_info, host)
+
+
+def get_es_client(elasticsearch_url,
+                  pool_maxsize=ES_POOL_MAXSIZE,
+                  sniff=False,
+                  http_compress=False):
+    """Returns an Elasticsearch client, once Elasticsearch is healthy.
+
+    Requests are spread round-robin over the nodes. A node that fails is
+    skipped for ES_DEAD_TIMEOUT_SEC, with exponential backoff.
+
+    Args:
+        elasticsearch_url: Elasticsearch url, or comma-separated urls of
+            several nodes of the same cluster.
+        pool_maxsize: Number of connections kept open to each node.
+        sniff: If true, find all data nodes of the cluster on startup, every
+            ES_SNIFFER_TIMEOUT_SEC and when a node fails, and send requests
+            to all of them.
+        http_compress: If true, gzip request bodies.
+    """
     # Retry flags needed for large datasets.
-    es = Elasticsearch([elasticsearch_url],
-                       retry_on_timeout=True,
-                       max_retries=10,
-                       timeout=30)
+    es = Elasticsearch(
+        elasticsearch_url.split(','),
+        connection_class=_KeepAliveHttpConnection,
+        retry_on_timeout=True,
+        max_retries=10,
+        timeout=30,
+        maxsize=pool_maxsize,
+        http_compress=http_compress,
+        dead_timeout=ES_DEAD_TIMEOUT_SEC,
+        sniff_on_connection_fail=sniff,
+        sniffer_timeout=ES_SNIFFER_TIMEOUT_SEC if sniff else None,
+        host_info_callback=_sniffed_host_info)
 
     _wait_elasticsearch_healthy(es)
+    if sniff:
+        # Sniff after Elasticsearch is up, rather than with sniff_on_start.
+        es.transport.sniff_hosts(True)
+        logger.info('Sniffed %d Elasticsearch nodes.' %
+                    len(es.transport.connection_pool.connections))
     return es
 
 
@@ -118,22 +244,177 @@ def maybe_create_elasticsearch_index(es, elasticsearch_url, index_name):
             })
 
 
-def _prepare_for_indexing(es):
+def _prepare_for_indexing(es, index_name):
     # Temporarily Update the settings to temporarily optimize for write-heavy performance.
-    es.indices.put_settings({
-        'index.refresh_interval': '-1',
-        'index.number_of_replicas': 0,
-    })
+    # Only update index_name, since other indices may be indexed concurrently.
+    es.indices.put_settings(
+        {
+            'index.refresh_interval': '-1',
+            'index.number_of_replicas': 0,
+        },
+        index=index_name)
+
+
+def _complete_indexing(es, index_name):
+    es.indices.put_settings(
+        {
+            'index.refresh_interval': '1s',
+            'index.number_of_replicas': 1,
+        },
+        index=index_name)
+
+
+def _murmur3_x86_32(data, seed=0):
+    """Returns MurmurHash3 (x86, 32-bit) of data, as an unsigned int."""
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    length = len(data)
+    h = seed
+    rounded_end = length & ~0x3
+    for i in range(0, rounded_end, 4):
+        k = int.from_bytes(data[i:i + 4], 'little')
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & 0xffffffff
+        h = (h * 5 + 0xe6546b64) & 0xffffffff
+    k = 0
+    tail = length & 0x3
+    if tail == 3:
+        k ^= data[rounded_end + 2] << 16
+    if tail >= 2:
+        k ^= data[rounded_end + 1] << 8
+    if tail >= 1:
+        k ^= data[rounded_end]
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+
+def _shard_id(_id, num_routing_shards, routing_factor):
+    """Returns the shard Elasticsearch routes a document with this _id to.
+
+    Same as Murmur3HashFunction.hash() and
+    OperationRouting.calculateScaledShardId() in Elasticsearch 6.
+    """
+    # Elasticsearch hashes the UTF-16 code units of the routing string, low byte
+    # first.
+    h = _murmur3_x86_32(str(_id).encode('utf-16-le'))
+    # Convert to signed, like the Java int. Python % is Java's Math.floorMod for
+    # positive divisors.
+    if h >= 1 << 31:
+        h -= 1 << 32
+    return (h % num_routing_shards) // routing_factor
+
+
+# Clients for single nodes, used by _shard_aware_bulk(). Keyed by the client
+# they were created from, then by node address. Cached so that each table
+# doesn't open new connection pools to every node.
+_node_clients = weakref.WeakKeyDictionary()
+_node_clients_lock = threading.Lock()
+
+
+def _node_client(es, address):
+    """Returns a client for the node at address, like "10.0.0.5:9200"."""
+    with _node_clients_lock:
+        clients = _node_clients.setdefault(es, {})
+        if address not in clients:
+            host, port = address.rsplit(':', 1)
+            # Use the same scheme, credentials and connection settings as es.
+            node = dict(es.transport.hosts[0], host=host, port=int(port))
+            clients[address] = Elasticsearch(
+                [node],
+                connection_class=es.transport.connection_class,
+                retry_on_timeout=True,
+                max_retries=10,
+                **es.transport.kwargs)
+        return clients[address]
+
+
+def _primary_shard_clients(es, index_name):
+    """Returns a dict from shard id to a client for the node with its primary.
+
+    Nodes are found by sniffing the cluster that es is connected to. For GKE
+    deployments, these are the data nodes from
+    kubernetes-elasticsearch-cluster/es-data-stateful.yaml.
+    """
+    addresses_by_node_id = {}
+    for node_id, node in es.nodes.info(metric='http')['nodes'].items():
+        # publish_address looks like "10.0.0.5:9200" or
+        # "es-data-0/10.0.0.5:9200".
+        address = node['http']['publish_address'].split('/')[-1]
+        addresses_by_node_id[node_id] = address
+
+    addresses = set()
+    clients_by_shard_id = {}
+    for shard_copies in es.search_shards(index=index_name)['shards']:
+        for shard_copy in shard_copies:
+            if not shard_copy['primary']:
+                continue
+            address = addresses_by_node_id[shard_copy['node']]
+            addresses.add(address)
+            clients_by_shard_id[shard_copy['shard']] = _node_client(
+                es, address)
+    logger.info('Sending bulk requests for %s directly to %d nodes.' %
+                (index_name, len(addresses)))
+    return clients_by_shard_id
+
+
+def _shard_aware_bulk(es, index_name, actions):
+    """Like bulk(), but sends each action to the node with its primary shard.
+
+    This saves the coordinating node from fanning out each bulk request to
+    every shard. If a primary moves during indexing, requests still succeed;
+    the receiving node forwards them.
+    """
+    settings = es.indices.get_settings(
+        index=index_name)[index_name]['settings']['index']
+    num_shards = int(settings['number_of_shards'])
+    num_routing_shards = int(
+        settings.get('number_of_routing_shards', num_shards))
+    routing_factor = num_routing_shards // num_shards
+    clients_by_shard_id = _primary_shard_clients(es, index_name)
+
+    # Keep at most one chunk per shard in memory.
+    chunks = [[] for _ in range(num_shards)]
+    for action in actions:
+        shard_id = _shard_id(action['_id'], num_routing_shards, routing_factor)
+        chunks[shard_id].append(action)
+        if len(chunks[shard_id]) >= BULK_CHUNK_SIZE:
+            bulk(clients_by_shard_id[shard_id],
+                 chunks[shard_id],
+                 request_timeout=300)
+            chunks[shard_id] = []
+    for shard_id, chunk in enumerate(chunks):
+        if chunk:
+            bulk(clients_by_shard_id[shard_id], chunk, request_timeout=300)
 
 
-def _complete_indexing(es):
-    es.indices.put_settings({
-        'index.refresh_interval': '1s',
-        'index.number_of_replicas': 1,
-    })
+def _bulk(es, index_name, actions, shard_aware):
+    with metrics.span('update_settings', index=index_name):
+        _prepare_for_indexing(es, index_name)
+    # Time spent producing actions is charged to the stages of the caller, eg
+    # reading and transforming rows. What is left is sending bulk requests.
+    with metrics.span('bulk', index=index_name):
+        if shard_aware:
+            _shard_aware_bulk(es, index_name, actions)
+        else:
+            # For large datasets, the default timeout of 10s is sometimes not enough.
+            bulk(es, actions, request_timeout=300)
+    with metrics.span('update_settings', index=index_name):
+        _complete_indexing(es, index_name)
 
 
-def bulk_index_scripts(es, index_name, scripts_by_id):
+def bulk_index_scripts(es, index_name, scripts_by_id, shard_aware=False):
     # Use generator so we can index arbitrarily large iterators (like tables),
     # without having to load into memory.
     def es_actions(scripts_by_id):
@@ -150,13 +431,10 @@ def bulk_index_scripts(es, index_name, scripts_by_id):
                 'upsert': {},
             })
 
-    _prepare_for_indexing(es)
-    # For large datasets, the default timeout of 10s is sometimes not enough.
-    bulk(es, es_actions(scripts_by_id), request_timeout=300)
-    _complete_indexing(es)
+    _bulk(es, index_name, es_actions(scripts_by_id), shard_aware)
 
 
-def bulk_index_docs(es, index_name, docs_by_id):
+def bulk_index_docs(es, index_name, docs_by_id, shard_aware=False):
     # Use generator so we can index arbitrarily large iterators (like tables),
     # without having to load into memory.
     def es_actions(docs_by_id):
@@ -172,7 +450,4 @@ def bulk_index_docs(es, index_name, docs_by_id):
                 'doc_as_upsert': True
             })
 
-    _prepare_for_indexing(es)
-    # For large datasets, the default timeout of 10s is sometimes not enough.
-    bulk(es, es_actions(docs_by_id), request_timeout=300)
-    _complete_indexing(es)
+    _bulk(es, index_name, es_actions(docs_by_id), shard_aware)
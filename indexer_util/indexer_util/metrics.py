@@ -0,0 +1,350 @@
+"""Timed spans, counters and histograms for indexer runs.
+
+Metrics are off until enable() is called. When off, span() returns a shared
+no-op context manager, timed_iter() returns its argument unchanged, and inc()
+and observe() return immediately, so instrumented code runs as before.
+
+Spans and timed iterators measure stages. Stages nest per thread: a stage's
+self time excludes time spent in stages started inside it. For example,
+indexing a table is a pipeline of generators (download -> parse -> transform
+-> bulk); each stage is charged only for its own work, even though the bulk
+stage pulls rows through the others.
+
+Counters and histograms get the labels (eg index, table) of the innermost
+stage of the current thread, so code deep in the call stack, such as the
+Elasticsearch connection, doesn't need to know which table is being indexed.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('indexer.metrics')
+
+# Prefix of Prometheus metric names.
+PROMETHEUS_PREFIX = 'indexer_'
+# Upper bounds of bulk latency histogram buckets, in seconds.
+LATENCY_BUCKETS_SEC = [
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300
+]
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_start_time = None
+_spans = []
+# Keys are (name, labels), where labels is a sorted tuple of (key, value).
+_stages = {}
+_counters = {}
+_histograms = {}
+
+
+class _Frame(object):
+    __slots__ = ['labels', 'start', 'child_seconds']
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.start = time.perf_counter()
+        self.child_seconds = 0
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _current_labels():
+    stack = _stack()
+    return stack[-1].labels if stack else {}
+
+
+def _push(labels):
+    stack = _stack()
+    if stack:
+        labels = dict(stack[-1].labels, **labels)
+    frame = _Frame(labels)
+    stack.append(frame)
+    return frame
+
+
+def _pop(frame):
+    """Returns (seconds, self seconds) of frame."""
+    seconds = time.perf_counter() - frame.start
+    stack = _stack()
+    stack.pop()
+    if stack:
+        stack[-1].child_seconds += seconds
+    return seconds, seconds - frame.child_seconds
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _record_stage(stage, labels, self_seconds, count):
+    key = _key(stage, labels)
+    with _lock:
+        total = _stages.setdefault(key, [0, 0])
+        total[0] += self_seconds
+        total[1] += count
+
+
+class _Span(object):
+
+    def __init__(self, stage, labels):
+        self._stage = stage
+        self._labels = labels
+
+    def __enter__(self):
+        self._frame = _push(self._labels)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds, self_seconds = _pop(self._frame)
+        _record_stage(self._stage, self._frame.labels, self_seconds, 1)
+        with _lock:
+            _spans.append({
+                'stage': self._stage,
+                'labels': self._frame.labels,
+                'start_sec': self._frame.start - _start_time,
+                'seconds': seconds,
+                'self_seconds': self_seconds,
+                'thread': threading.current_thread().name,
+                'error': exc_type.__name__ if exc_type else None,
+            })
+
+
+class _NoopSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def enable():
+    """Starts recording metrics. Clears any previously recorded metrics."""
+    global _enabled, _start_time
+    with _lock:
+        _spans[:] = []
+        _stages.clear()
+        _counters.clear()
+        _histograms.clear()
+        _start_time = time.perf_counter()
+        _enabled = True
+
+
+def enabled():
+    return _enabled
+
+
+def span(stage, **labels):
+    """Returns a context manager that times stage.
+
+    Args:
+        stage: Stage name, eg 'extract_job'.
+        labels: Labels of this span and of stages, counters and histograms
+            recorded inside it, eg index='1000_genomes'.
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(stage, labels)
+
+
+def _timed_iter(iterable, stage, labels):
+    iterator = iter(iterable)
+    self_seconds = 0
+    count = 0
+    try:
+        while True:
+            frame = _push(labels)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                self_seconds += _pop(frame)[1]
+            count += 1
+            yield item
+    finally:
+        # Record once, rather than once per item.
+        _record_stage(stage, frame.labels, self_seconds, count)
+
+
+def timed_iter(iterable, stage, **labels):
+    """Returns an iterator over iterable, which times stage.
+
+    The time to produce each item is charged to stage, and the number of items
+    is recorded as the stage count. Use this for generator stages, where a
+    span would be suspended at each yield.
+    """
+    if not _enabled:
+        return iterable
+    return _timed_iter(iterable, stage, labels)
+
+
+def inc(name, value=1):
+    """Adds value to counter name."""
+    if not _enabled:
+        return
+    key = _key(name, _current_labels())
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value):
+    """Adds value to histogram name, which has LATENCY_BUCKETS_SEC buckets."""
+    if not _enabled:
+        return
+    key = _key(name, _current_labels())
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                'buckets': [0] * (len(LATENCY_BUCKETS_SEC) + 1),
+                'sum': 0,
+                'count': 0
+            }
+        for i, bound in enumerate(LATENCY_BUCKETS_SEC):
+            if value <= bound:
+                break
+        else:
+            i = len(LATENCY_BUCKETS_SEC)
+        histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def _histogram_report(name, labels, histogram):
+    # Unlike Prometheus buckets, these buckets are not cumulative.
+    bounds = LATENCY_BUCKETS_SEC + ['+Inf']
+    buckets = [{
+        'le': bound,
+        'count': count
+    } for bound, count in zip(bounds, histogram['buckets'])]
+    return {
+        'name': name,
+        'labels': dict(labels),
+        'buckets': buckets,
+        'sum': histogram['sum'],
+        'count': histogram['count']
+    }
+
+
+def report():
+    """Returns recorded metrics as a JSON-serializable dict."""
+    with _lock:
+        stages = [{
+            'stage': stage,
+            'labels': dict(labels),
+            'self_seconds': total[0],
+            'count': total[1]
+        } for (stage, labels), total in sorted(_stages.items())]
+        counters = [{
+            'name': name,
+            'labels': dict(labels),
+            'value': value
+        } for (name, labels), value in sorted(_counters.items())]
+        histograms = [
+            _histogram_report(name, labels, histogram)
+            for (name, labels), histogram in sorted(_histograms.items())
+        ]
+        return {
+            'duration_sec': time.perf_counter() - _start_time,
+            'stages': stages,
+            'counters': counters,
+            'histograms': histograms,
+            'spans': sorted(_spans, key=lambda s: s['start_sec']),
+        }
+
+
+def _escape_label_value(value):
+    # Escape backslash, double quote and newline, per the text format.
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+def _prometheus_labels(labels, **extra_labels):
+    labels = sorted(list(labels) + list(extra_labels.items()))
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape_label_value(v))
+                             for k, v in labels)
+
+
+def prometheus_text():
+    """Returns recorded metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        name = PROMETHEUS_PREFIX + 'stage_seconds_total'
+        lines.append('# HELP %s Self time of indexer stages.' % name)
+        lines.append('# TYPE %s counter' % name)
+        for (stage, labels), total in sorted(_stages.items()):
+            lines.append(
+                '%s%s %r' %
+                (name, _prometheus_labels(labels, stage=stage), total[0]))
+        name = PROMETHEUS_PREFIX + 'stage_items_total'
+        lines.append('# HELP %s Number of runs or items of indexer stages.' %
+                     name)
+        lines.append('# TYPE %s counter' % name)
+        for (stage, labels), total in sorted(_stages.items()):
+            lines.append(
+                '%s%s %d' %
+                (name, _prometheus_labels(labels, stage=stage), total[1]))
+
+        for counter_name in sorted(set(k[0] for k in _counters)):
+            name = '%s%s_total' % (PROMETHEUS_PREFIX, counter_name)
+            lines.append('# TYPE %s counter' % name)
+            for (n, labels), value in sorted(_counters.items()):
+                if n == counter_name:
+                    lines.append('%s%s %r' %
+                                 (name, _prometheus_labels(labels), value))
+
+        for histogram_name in sorted(set(k[0] for k in _histograms)):
+            name = PROMETHEUS_PREFIX + histogram_name
+            lines.append('# TYPE %s histogram' % name)
+            for (n, labels), histogram in sorted(_histograms.items()):
+                if n != histogram_name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS_SEC + ['+Inf'],
+                                        histogram['buckets']):
+                    cumulative += count
+                    bucket_labels = _prometheus_labels(labels, le=bound)
+                    lines.append('%s_bucket%s %d' %
+                                 (name, bucket_labels, cumulative))
+                histogram_labels = _prometheus_labels(labels)
+                lines.append('%s_sum%s %r' %
+                             (name, histogram_labels, histogram['sum']))
+                lines.append('%s_count%s %d' %
+                             (name, histogram_labels, histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomically(path, text):
+    # Write to a temporary file and rename, so that readers such as the
+    # node_exporter textfile collector never see a partial file.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_report(path):
+    """Writes report() as JSON to path."""
+    _write_atomically(path, json.dumps(report(), indent=2, sort_keys=True))
+    logger.info('Wrote metrics report to %s.' % path)
+
+
+def write_prometheus_textfile(path):
+    """Writes prometheus_text() to path, which should end in .prom."""
+    _write_atomically(path, prometheus_text())
+    logger.info('Wrote Prometheus metrics to %s.' % path)